@@ -1,8 +1,21 @@
 import networkx as nx
 import math
 import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import sys
+import time
+import weakref
+from array import array
+from bisect import bisect_left
+from collections import deque
 from heapq import heappop, heappush
 from itertools import count
+from multiprocessing import shared_memory
 from pathlib import Path
 
 # From networkx, adapted to use multiple targets
@@ -58,28 +71,89 @@ def dijkstra_multisource_multitarget(
     the caller through the original pred and paths objects passed
     as arguments. No need to explicitly return pred or paths.
 
+    On a graph built by compress_network, collapsed chains are walked hop by
+    hop with the original edge data, so distances and paths are the same as on
+    the uncompressed graph. Each hop still takes one heap push and pop, so the
+    heap work is unchanged; only the path lists of the hidden nodes are not
+    built. Paths are expanded back to the original nodes, but nodes hidden
+    inside a chain only appear in the distances if they were sources.
+
     """
     G_succ = G._adj  # For speed-up (and works for both directed and undirected graphs)
+    # Side tables left behind by compress_network (empty for uncompressed graphs)
+    chains = G.graph.get("chains", {})
+    chain_nodes = G.graph.get("chain_nodes", {})
 
     dist = {}  # dictionary of final distances
     seen = {}
-    # fringe is heapq with 3-tuples (distance,c,node)
+    # fringe is heapq with 4-tuples (distance,c,node,step)
     # use the count c to avoid comparing nodes (may not be able to)
+    # step is None for graph nodes. For nodes hidden inside a collapsed chain it is
+    # (origin, hops, start, i): the chain is walked one hop per heap entry, so every
+    # count is drawn in the same order as it would be on the uncompressed graph.
     c = count()
     fringe = []
     for source in sources:
         seen[source] = 0
-        heappush(fringe, (0, next(c), source))
+        if source in chain_nodes:
+            hops, i = chain_nodes[source]
+            heappush(fringe, (0, next(c), source, (source, hops, i, i)))
+        else:
+            heappush(fringe, (0, next(c), source, None))
     while fringe:
-        (d, _, v) = heappop(fringe)
+        (d, _, v, step) = heappop(fringe)
         if v in dist:
             continue  # already searched this node.
-        dist[v] = d
-        if targets and v in targets:
-            targets.remove(v)
-            if len(targets) == 0:
-                break
+        if step is None or step[2] == step[3]:
+            dist[v] = d
+            if targets and v in targets:
+                targets.remove(v)
+                if len(targets) == 0:
+                    break
+        if step is not None:
+            # Take the next hop of the chain
+            origin, hops, start, i = step
+            x, u, e = hops[i]
+            cost = weight(x, u, e)
+            if cost is None:
+                continue
+            vu_dist = d + cost
+            if cutoff is not None:
+                if vu_dist > cutoff:
+                    continue
+            if i + 1 < len(hops):
+                heappush(fringe, (vu_dist, next(c), u, (origin, hops, start, i + 1)))
+                continue
+            # Last hop: u is back in the compressed graph
+            if u in dist:
+                u_dist = dist[u]
+                if vu_dist < u_dist:
+                    raise ValueError("Contradictory paths found:", "negative weights?")
+                elif pred is not None and vu_dist == u_dist:
+                    pred[u].append(x)
+            elif u not in seen or vu_dist < seen[u]:
+                seen[u] = vu_dist
+                heappush(fringe, (vu_dist, next(c), u, None))
+                if paths is not None:
+                    paths[u] = paths[origin] + [hop[1] for hop in hops[start:-1]] + [u]
+                if pred is not None:
+                    pred[u] = [x]
+            elif vu_dist == seen[u]:
+                if pred is not None:
+                    pred[u].append(x)
+            continue
+        v_chains = chains.get(v)
         for u, e in G_succ[v].items():
+            if v_chains and u in v_chains:
+                # Super-edge: start walking the chain it stands for
+                hops = v_chains[u]
+                cost = weight(*hops[0])
+                if cost is None:
+                    continue
+                vu_dist = dist[v] + cost
+                if cutoff is None or vu_dist <= cutoff:
+                    heappush(fringe, (vu_dist, next(c), hops[0][1], (v, hops, 0, 1)))
+                continue
             cost = weight(v, u, e)
             if cost is None:
                 continue
@@ -95,7 +169,7 @@ def dijkstra_multisource_multitarget(
                     pred[u].append(v)
             elif u not in seen or vu_dist < seen[u]:
                 seen[u] = vu_dist
-                heappush(fringe, (vu_dist, next(c), u))
+                heappush(fringe, (vu_dist, next(c), u, None))
                 if paths is not None:
                     paths[u] = paths[v] + [u]
                 if pred is not None:
@@ -108,6 +182,155 @@ def dijkstra_multisource_multitarget(
     # by the caller via the pred and paths objects passed as arguments.
     return dist
 
+
+def bfs_multisource_multitarget(
+    G, sources, cost, pred=None, paths=None, cutoff=None, targets: list|None=None
+):
+    """Breadth-first search for graphs where every edge has the same cost.
+
+    Gives the same distances, paths, predecessors and tie-breaking as
+    dijkstra_multisource_multitarget, without a heap or weight function:
+    with equal costs, nodes are reached in first-in first-out order.
+
+    Parameters
+    ----------
+    G : NetworkX graph
+
+    sources : non-empty iterable of nodes
+
+    cost : non-negative integer or float
+        The cost of every edge in G.
+
+    pred, paths, cutoff, targets :
+        As for dijkstra_multisource_multitarget.
+
+    Returns
+    -------
+    distance : dictionary
+        A mapping from node to shortest distance to that node from one
+        of the source nodes.
+
+    """
+    G_succ = G._adj
+    chains = G.graph.get("chains", {})
+    chain_nodes = G.graph.get("chain_nodes", {})
+
+    dist = {}  # dictionary of final distances
+    seen = {}
+    # fringe is a queue of 3-tuples (distance,node,step), see dijkstra_multisource_multitarget for step
+    fringe = deque()
+    for source in sources:
+        seen[source] = 0
+        if source in chain_nodes:
+            hops, i = chain_nodes[source]
+            fringe.append((0, source, (source, hops, i, i)))
+        else:
+            fringe.append((0, source, None))
+    while fringe:
+        (d, v, step) = fringe.popleft()
+        if v in dist:
+            continue  # already searched this node.
+        if step is None or step[2] == step[3]:
+            dist[v] = d
+            if targets and v in targets:
+                targets.remove(v)
+                if len(targets) == 0:
+                    break
+        vu_dist = d + cost
+        if cutoff is not None:
+            if vu_dist > cutoff:
+                continue
+        if step is not None:
+            # Take the next hop of the chain
+            origin, hops, start, i = step
+            x, u, _ = hops[i]
+            if i + 1 < len(hops):
+                fringe.append((vu_dist, u, (origin, hops, start, i + 1)))
+            elif u not in seen:
+                seen[u] = vu_dist
+                fringe.append((vu_dist, u, None))
+                if paths is not None:
+                    paths[u] = paths[origin] + [hop[1] for hop in hops[start:-1]] + [u]
+                if pred is not None:
+                    pred[u] = [x]
+            elif pred is not None and vu_dist == seen[u]:
+                pred[u].append(x)
+            continue
+        v_chains = chains.get(v)
+        for u in G_succ[v]:
+            if v_chains and u in v_chains:
+                # Super-edge: start walking the chain it stands for
+                hops = v_chains[u]
+                fringe.append((vu_dist, hops[0][1], (v, hops, 0, 1)))
+            elif u not in seen:
+                # Equal non-negative costs never improve on a node that was already seen
+                seen[u] = vu_dist
+                fringe.append((vu_dist, u, None))
+                if paths is not None:
+                    paths[u] = paths[v] + [u]
+                if pred is not None:
+                    pred[u] = [v]
+            elif pred is not None and vu_dist == seen[u]:
+                pred[u].append(v)
+
+    return dist
+
+
+def classify_weights(G, weight) -> tuple[str, float | None]:
+    """
+    Classify the edge costs of a network, to pick the cheapest search that gives the same result as Dijkstra.
+    @param G: the network, possibly built by compress_network
+    @param weight: function with (u, v, data) input that returns that edge's cost
+    @return ("uniform", cost) if every edge has the same non-negative cost, ("negative", None) if any cost is
+    negative (a weight above 1), and ("general", None) otherwise
+    """
+    chains = G.graph.get("chains", {})
+
+    def costs():
+        for u, v, data in G.edges(data=True):
+            if v in chains.get(u, {}):
+                yield from (weight(*hop) for hop in chains[u][v])
+            else:
+                yield weight(u, v, data)
+
+    return classify_costs(costs())
+
+
+def classify_costs(edge_costs) -> tuple[str, float | None]:
+    """
+    Classify edge costs as classify_weights does.
+    @param edge_costs: iterable of the cost of every edge
+    @return see classify_weights
+    """
+    costs = set()
+    for cost in edge_costs:
+        if cost is not None and cost < 0:
+            return "negative", None
+        if len(costs) <= 1:
+            costs.add(cost)
+    if len(costs) > 1 or None in costs:
+        return "general", None
+    return "uniform", costs.pop() if costs else 1
+
+
+def multisource_multitarget(
+    G, sources, weight, weight_class=None, pred=None, paths=None, cutoff=None, targets: list|None=None
+):
+    """
+    Find shortest paths with the search that suits the edge costs: breadth-first search when all costs are equal
+    and Dijkstra's algorithm otherwise. Both give the same result.
+    @param weight_class: the result of classify_weights(G, weight), which is computed if not given
+    @return the distances from the sources, with the other parameters as for dijkstra_multisource_multitarget
+    """
+    kind, cost = weight_class if weight_class is not None else classify_weights(G, weight)
+    if kind == "negative":
+        # With negative costs a search that stops at the targets can return wrong distances, where searching on
+        # reaches the edge that makes dijkstra_multisource_multitarget raise "Contradictory paths found"
+        targets = None
+    if kind == "uniform":
+        return bfs_multisource_multitarget(G, sources, cost, pred=pred, paths=paths, cutoff=cutoff, targets=targets)
+    return dijkstra_multisource_multitarget(G, sources, weight, pred=pred, paths=paths, cutoff=cutoff, targets=targets)
+
 def parse_arguments():
     """
     Process command line arguments.
@@ -129,23 +352,75 @@ def parse_arguments():
         required=True,
         help="Path to the output file that will be written",
     )
+    parser.add_argument(
+        "--storage",
+        choices=["memory", "mmap"],
+        default="memory",
+        help="Hold the network in memory, or in memory-mapped files for networks larger than memory",
+    )
+    parser.add_argument(
+        "--store_dir",
+        type=Path,
+        help="Directory for the memory-mapped network (default: next to the output file)",
+    )
+    parser.add_argument(
+        "--max_rss",
+        type=float,
+        help="Resident memory limit in MiB for --storage mmap. Above it, mapped pages are dropped if they make up "
+        "much of the resident memory, and a warning is printed if that does not bring it under the limit. "
+        "Other storage modes reject it",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Also run with the other storage and report the throughput of memory-mapped storage relative to memory",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Save the search state next to the output file and reuse the searches of the last run that the "
+        "changes to the edges file do not affect",
+    )
+    parser.add_argument(
+        "--ensemble",
+        type=int,
+        help="Run this many replicates with perturbed weights and write how often each edge is in their pathways",
+    )
+    parser.add_argument(
+        "--perturbation",
+        choices=PERTURBATIONS,
+        default="lognormal",
+        help="How --ensemble perturbs the -log(weight) edge costs: add noise * N(0, 1) or U(-noise, noise), "
+        "reflecting costs below 0",
+    )
+    parser.add_argument(
+        "--noise", type=float, default=0.1, help="The scale of the --ensemble perturbation (default: 0.1)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="The seed of the --ensemble perturbations (default: 0)"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="The number of --ensemble worker processes (default: one per CPU)"
+    )
 
     return parser.parse_args()
 
 
 # functions for reading input files
 def read_edges(network_file: Path) -> list:
-    network = []
     print(network_file)
+    return list(iter_edges(network_file))
+
+
+def iter_edges(network_file: Path):
     with open(network_file, "r") as f:
         for line in f:
             line = line.strip()
             line = line.split("\t")
             if len(line) == 3:  # check if there are exactly three elements in the line
-                network.append((line[0], line[1], float(line[2])))
+                yield (line[0], line[1], float(line[2]))
             else:
-                network.append((line[0], line[1], float(1)))
-    return network
+                yield (line[0], line[1], float(1))
 
 
 def read_source_target(source_file: Path, target_file: Path) -> tuple[list[str], list[str]]:
@@ -171,6 +446,945 @@ def construct_network(network: list, source: list[str], target: list[str]) -> nx
     return Network
 
 
+def compress_network(network: nx.DiGraph, terminals: list, weight: str = "weight") -> nx.DiGraph:
+    """
+    Build a smaller copy of the network that gives the same search results between terminals.
+    Non-terminal nodes that can not be on a path between terminals (dangling trees hanging off the network)
+    are dropped, and chains of non-terminal nodes with in- and out-degree 1 are collapsed into super-edges.
+    A super-edge has no data of its own: its hops are kept in network.graph["chains"] and the searches walk
+    them one heap (or queue) entry per hop, in their original order, so ties break exactly as on the original
+    network. Dropping dangling trees saves whole searches' worth of work, but a chain costs the same heap work
+    as before; what collapsing it saves is building a path list for every hidden node, as the path through a
+    chain is only built once its last hop is reached. The network is returned as-is if it has negative weights.
+    @param network: the network, after any weight transformation
+    @param terminals: the sources and targets
+    @param weight: the edge attribute holding the weights
+    @return the compressed network
+    """
+    if any(data.get(weight, 1) < 0 for _, _, data in network.edges(data=True)):
+        return network
+
+    terminals = set(terminals)
+    succ = {n: set(network._succ[n]) for n in network}
+    pred = {n: set(network._pred[n]) for n in network}
+
+    def neighbors(n):
+        return succ[n] | pred[n]
+
+    # Drop dangling nodes: never reached (no in-edges), dead ends (no out-edges), or pendants whose only
+    # neighbor is the node they were reached from. Dropping one can leave its neighbor dangling too.
+    removed = set()
+    stack = [n for n in network if n not in terminals]
+    while stack:
+        n = stack.pop()
+        if n in removed or n in succ[n]:
+            continue
+        if succ[n] and pred[n] and len(neighbors(n)) > 1:
+            continue
+        removed.add(n)
+        for m in neighbors(n):
+            succ[m].discard(n)
+            pred[m].discard(n)
+            if m not in terminals:
+                stack.append(m)
+
+    def in_chain(n):
+        return (
+            n not in terminals
+            and n not in removed
+            and len(succ[n]) == 1
+            and len(pred[n]) == 1
+            and n not in succ[n]
+            and succ[n] != pred[n]
+        )
+
+    # Collapse maximal chains a -> x1 -> ... -> xk -> b into super-edges a -> b
+    chains = {}  # first node -> {last node: [(u, v, data) for each hop of the chain]}
+    chain_nodes = {}  # node in a chain -> (hops, index of the hop leaving it)
+    visited = set()
+    for n in network:
+        if n in visited or not in_chain(n):
+            continue
+        # Walk back to the start of the chain
+        first = n
+        while in_chain(next(iter(pred[first]))) and next(iter(pred[first])) != n:
+            first = next(iter(pred[first]))
+        interior = [first]
+        while in_chain(next(iter(succ[interior[-1]]))) and next(iter(succ[interior[-1]])) != first:
+            interior.append(next(iter(succ[interior[-1]])))
+        visited.update(interior)
+        a = next(iter(pred[first]))
+        b = next(iter(succ[interior[-1]]))
+        # Leave chains that are cycles or that would clash with an existing edge
+        if in_chain(a) or a == b or b in succ[a] or b in chains.get(a, {}):
+            continue
+        nodes = [a] + interior + [b]
+        hops = [(nodes[i], nodes[i + 1], network._succ[nodes[i]][nodes[i + 1]]) for i in range(len(nodes) - 1)]
+        chains.setdefault(a, {})[b] = hops
+        for i in range(1, len(hops)):
+            chain_nodes[hops[i][0]] = (hops, i)
+
+    # Rebuild the network in the original node and adjacency order, with each super-edge
+    # taking the place of the first edge of its chain
+    compressed = nx.DiGraph()
+    compressed.add_nodes_from(n for n in network if n not in removed and n not in chain_nodes)
+    for u in compressed:
+        for v, data in network._succ[u].items():
+            if v in removed:
+                continue
+            if v in chain_nodes:
+                hops, _ = chain_nodes[v]
+                if hops[0][0] == u:
+                    b = hops[-1][1]
+                    compressed.add_edge(u, b)
+            else:
+                compressed.add_edge(u, v, **data)
+    compressed.graph["chains"] = chains
+    compressed.graph["chain_nodes"] = chain_nodes
+    return compressed
+
+
+# functions for storing the network as compressed sparse rows
+class CSRGraph:
+    """
+    One direction of a network stored as compressed sparse rows, which the *_multisource_multitarget searches
+    accept in place of a NetworkX graph. Nodes are the integers 0 to n - 1 and the data of each edge is its index
+    in the forward edge arrays, so a cost array serves as the weight: lambda u, v, e: costs[e].
+    Nodes past the last row (such as terminals missing from the edges file) have no edges.
+    """
+
+    def __init__(self, indptr, indices, edge_ids=None, memory_guard=None):
+        """
+        @param indptr: the edges of node i are indptr[i] up to indptr[i + 1]
+        @param indices: the node at the other end of each edge
+        @param edge_ids: the forward index of each edge, for reversed networks (the position if None)
+        @param memory_guard: function called every MEMORY_CHECK_INTERVAL rows read by a search
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_ids = edge_ids
+        self.graph = {}
+        self._adj = _CSRAdjacency(self, memory_guard)
+
+
+class _CSRAdjacency:
+    def __init__(self, graph: CSRGraph, memory_guard):
+        self.graph = graph
+        self.memory_guard = memory_guard
+        self.rows = 0
+
+    def __getitem__(self, v):
+        if self.memory_guard is not None:
+            self.rows += 1
+            if self.rows % MEMORY_CHECK_INTERVAL == 0:
+                self.memory_guard()
+        graph = self.graph
+        if v + 1 >= len(graph.indptr):
+            return _CSRRow((), ())
+        lo, hi = graph.indptr[v], graph.indptr[v + 1]
+        return _CSRRow(graph.indices[lo:hi], range(lo, hi) if graph.edge_ids is None else graph.edge_ids[lo:hi])
+
+
+class _CSRRow:
+    __slots__ = ("neighbors", "edges")
+
+    def __init__(self, neighbors, edges):
+        self.neighbors = neighbors
+        self.edges = edges
+
+    def __iter__(self):
+        return iter(self.neighbors)
+
+    def items(self):
+        return zip(self.neighbors, self.edges)
+
+
+# How many rows a search reads between checks of the memory limit
+MEMORY_CHECK_INTERVAL = 1 << 16
+# The smallest share of the resident set that file-backed pages must make up for dropping them to be worth it
+MIN_MAPPED_SHARE = 0.5
+# How many edges to hold in memory while writing a MappedNetwork
+WRITE_BUFFER_SIZE = 1 << 16
+
+
+class MappedNetwork:
+    """
+    A network stored on disk as memory-mapped compressed sparse rows, for networks too large to load as a
+    NetworkX graph. Searches only page in the parts of the arrays they touch. The store directory holds:
+    - indptr, indices, weights, costs: the edges in the neighbor order NetworkX would use, with the weights
+      from the edges file and their negative log transformed costs
+    - rindptr, rindices, redges: the reversed edges, with the forward index of each edge
+    - names, name_offsets, name_order: the UTF-8 node names, where each one starts, and the node IDs in name order
+    - meta.json: the sizes, the weight class of the costs, the edges file the store was built from and the
+      store version
+    """
+
+    VERSION = 1
+
+    ARRAYS = {
+        "indptr": "q",
+        "indices": "i",
+        "weights": "d",
+        "costs": "d",
+        "rindptr": "q",
+        "rindices": "i",
+        "redges": "q",
+        "name_offsets": "q",
+        "name_order": "i",
+        "names": "B",
+    }
+
+    def __init__(self, store_dir: Path, max_rss: int | None = None):
+        """
+        Open a store written by MappedNetwork.build.
+        @param store_dir: the store directory
+        @param max_rss: the resident set size in bytes above which searches drop mapped pages, see check_memory
+        """
+        with open(Path(store_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.max_rss = max_rss
+        self.over_limit = False
+        self._maps = []
+        for name, typecode in self.ARRAYS.items():
+            mapped, view = _map_array(Path(store_dir, name), typecode)
+            self._maps.append((mapped, view))
+            setattr(self, name, view)
+        self.weight_class = tuple(self.meta["weight_class"])
+        memory_guard = self.check_memory if max_rss is not None else None
+        self.forward = CSRGraph(self.indptr, self.indices, memory_guard=memory_guard)
+        self.reverse = CSRGraph(self.rindptr, self.rindices, self.redges, memory_guard=memory_guard)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_edges(cls, edges_file: Path, store_dir: Path, max_rss: int | None = None) -> "MappedNetwork":
+        """
+        Open the store for an edges file, building it first if it is missing, older than the edges file or
+        written by another version.
+        """
+        meta_file = Path(store_dir, "meta.json")
+        if meta_file.exists():
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+            if meta.get("version") == cls.VERSION and meta["edges_file"] == _file_signature(edges_file):
+                return cls(store_dir, max_rss)
+        cls.build(edges_file, store_dir)
+        return cls(store_dir, max_rss)
+
+    @classmethod
+    def build(cls, edges_file: Path, store_dir: Path) -> None:
+        """
+        Write the store for an edges file. Only the node name table and per-node counts are held in memory,
+        the edges are spilled to disk and sorted into rows through memory-mapped files.
+        @param edges_file: the tab-separated edges file, as read by read_edges
+        @param store_dir: the store directory, created if needed
+        """
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        spill = {"tails": "i", "heads": "i", "spilled_weights": "d"}
+
+        # Intern the node names in the order NetworkX adds them and spill the edges to disk in file order
+        ids = {}
+        offset = 0
+        with (
+            open(Path(store_dir, "names"), "wb") as names,
+            open(Path(store_dir, "name_offsets"), "wb") as name_offsets,
+            _ArrayWriter(store_dir, spill) as spilled,
+        ):
+            name_offsets.write(array("q", [offset]))
+            for u, v, w in iter_edges(edges_file):
+                for node in (u, v):
+                    if node not in ids:
+                        ids[node] = len(ids)
+                        encoded = node.encode()
+                        names.write(encoded)
+                        offset += len(encoded)
+                        name_offsets.write(array("q", [offset]))
+                spilled.append(ids[u], ids[v], w)
+        n = len(ids)
+        # Python orders strings by code point, which is also the order of their UTF-8 bytes
+        with open(Path(store_dir, "name_order"), "wb") as f:
+            f.write(array("i", (ids[name] for name in sorted(ids))))
+        del ids
+
+        # Counting sort the edges into rows, keeping the file order within each row
+        tails_map, tails = _map_array(Path(store_dir, "tails"), "i")
+        heads_map, heads = _map_array(Path(store_dir, "heads"), "i")
+        spilled_map, spilled_weights = _map_array(Path(store_dir, "spilled_weights"), "d")
+        starts = _row_starts(tails, n)
+        placed_heads_map, placed_heads = _map_array(Path(store_dir, "placed_heads"), "i", len(tails))
+        placed_weights_map, placed_weights = _map_array(Path(store_dir, "placed_weights"), "d", len(tails))
+        position = array("q", starts)
+        for k in range(len(tails)):
+            u = tails[k]
+            placed_heads[position[u]] = heads[k]
+            placed_weights[position[u]] = spilled_weights[k]
+            position[u] += 1
+        del position
+        _close_maps((tails_map, tails), (heads_map, heads), (spilled_map, spilled_weights))
+
+        # Write the rows, dropping repeated edges the way NetworkX does: the first position wins with the
+        # last weight. The costs are transformed as in BTB_main.
+        indptr = array("q", [0])
+        costs_seen = set()
+        row_heads = row_weights = None
+        with _ArrayWriter(store_dir, {"indices": "i", "weights": "d", "costs": "d"}) as rows:
+            for u in range(n):
+                row_heads = placed_heads[starts[u]:starts[u + 1]]
+                row_weights = placed_weights[starts[u]:starts[u + 1]]
+                if len(set(row_heads)) < len(row_heads):
+                    row = dict(zip(row_heads, row_weights))
+                    row_heads, row_weights = array("i", row), array("d", row.values())
+                row_costs = weight_costs(row_weights)
+                rows.extend(row_heads, row_weights, row_costs)
+                # Enough of the costs for classify_costs: the first two distinct ones and any negative one
+                if len(costs_seen) <= 1:
+                    costs_seen.update(row_costs)
+                elif min(row_costs, default=0) < 0:
+                    costs_seen.add(min(row_costs))
+                indptr.append(indptr[-1] + len(row_heads))
+            del row_heads, row_weights
+        with open(Path(store_dir, "indptr"), "wb") as f:
+            f.write(indptr)
+        _close_maps((placed_heads_map, placed_heads), (placed_weights_map, placed_weights))
+
+        # Reverse the edges, with the tails of each node in node order as in DiGraph.reverse
+        indices_map, indices = _map_array(Path(store_dir, "indices"), "i")
+        rindptr = _row_starts(indices, n)
+        rindices_map, rindices = _map_array(Path(store_dir, "rindices"), "i", len(indices))
+        redges_map, redges = _map_array(Path(store_dir, "redges"), "q", len(indices))
+        _reverse_rows(indptr, indices, rindptr, rindices, redges)
+        with open(Path(store_dir, "rindptr"), "wb") as f:
+            f.write(rindptr)
+        _close_maps((indices_map, indices), (rindices_map, rindices), (redges_map, redges))
+
+        for name in list(spill) + ["placed_heads", "placed_weights"]:
+            Path(store_dir, name).unlink()
+        with open(Path(store_dir, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "nodes": n,
+                    "edges": indptr[-1],
+                    "weight_class": classify_costs(costs_seen),
+                    "edges_file": _file_signature(edges_file),
+                    "version": cls.VERSION,
+                },
+                f,
+            )
+
+    def node_id(self, name: str) -> int | None:
+        """
+        Look up a node by name with a binary search of the on-disk name order.
+        @return the node ID, or None if the node has no edges
+        """
+        i = bisect_left(self.name_order, name, key=self.node_name)
+        if i < len(self.name_order) and self.node_name(self.name_order[i]) == name:
+            return self.name_order[i]
+        return None
+
+    def node_name(self, i: int) -> str:
+        return bytes(self.names[self.name_offsets[i]:self.name_offsets[i + 1]]).decode()
+
+    def check_memory(self) -> None:
+        """
+        If the process is above max_rss, drop the mapped pages from memory when file-backed pages are at least
+        MIN_MAPPED_SHARE of the resident set. They are read back from disk when a search touches them again.
+        The rest of the resident set is the search state (distances, paths and D), which this can not free, so
+        if the process is still above max_rss a warning is printed, once per network.
+        """
+        memory = resident_memory()
+        if memory is None or memory[0] <= self.max_rss:
+            return
+        rss, file_rss = memory
+        if file_rss >= MIN_MAPPED_SHARE * rss:
+            for mapped, _ in self._maps:
+                if mapped is not None:
+                    mapped.madvise(mmap.MADV_DONTNEED)
+            rss = resident_memory()[0]
+        if rss > self.max_rss and not self.over_limit:
+            self.over_limit = True
+            print(
+                f"Resident memory {rss / 2**20:.1f} MiB is above max_rss {self.max_rss / 2**20:.1f} MiB "
+                f"after dropping what mapped pages could be dropped",
+                file=sys.stderr,
+            )
+
+    def close(self) -> None:
+        _close_maps(*self._maps)
+        self._maps = []
+
+
+class PreparedNetwork:
+    """
+    A network held in memory as compressed sparse rows, with the same arrays and methods as MappedNetwork.
+    The weights are transformed into costs once, so repeated BowTieBuilder runs from Python start searching
+    right away.
+    """
+
+    def __init__(self, edges):
+        """
+        @param edges: iterable of (node1, node2) or (node1, node2, weight) tuples. Repeated edges keep their first
+        position and last weight, as in a NetworkX graph.
+        """
+        ids = {}
+        rows = []
+        for edge in edges:
+            for node in edge[:2]:
+                if node not in ids:
+                    ids[node] = len(ids)
+                    rows.append({})
+            rows[ids[edge[0]]][ids[edge[1]]] = float(edge[2]) if len(edge) > 2 else 1.0
+        self._ids = ids
+        self.names = list(ids)
+
+        self.indptr = array("q", [0])
+        self.indices = array("i")
+        self.weights = array("d")
+        for row in rows:
+            self.indices.extend(row)
+            self.weights.extend(row.values())
+            self.indptr.append(len(self.indices))
+        del rows
+        self.costs = weight_costs(self.weights)
+        self.weight_class = classify_costs(self.costs)
+
+        n = len(self.names)
+        self.rindptr = _row_starts(self.indices, n)
+        self.rindices = array("i", bytes(4 * len(self.indices)))
+        self.redges = array("q", bytes(8 * len(self.indices)))
+        _reverse_rows(self.indptr, self.indices, self.rindptr, self.rindices, self.redges)
+
+        self.meta = {"nodes": n, "edges": len(self.indices), "weight_class": list(self.weight_class)}
+        self.forward = CSRGraph(self.indptr, self.indices)
+        self.reverse = CSRGraph(self.rindptr, self.rindices, self.redges)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_arrays(cls, tails, heads, weights=None) -> "PreparedNetwork":
+        """
+        Prepare a network from columns of edges, such as lists, arrays or NumPy arrays.
+        @param tails: the first node of each edge
+        @param heads: the second node of each edge
+        @param weights: the weight of each edge, or None to weigh every edge 1
+        """
+        return cls(zip(tails, heads) if weights is None else zip(tails, heads, weights))
+
+    def node_id(self, name) -> int | None:
+        """
+        @return the node ID, or None if the node has no edges
+        """
+        return self._ids.get(name)
+
+    def node_name(self, i: int):
+        return self.names[i]
+
+
+class SharedNetwork:
+    """
+    A network whose arrays and node name table live in one multiprocessing.shared_memory segment, laid out as in
+    MappedNetwork, so that worker processes search it without a copy of their own. Workers attach with
+    SharedNetwork(*network.handle), or by unpickling it; unpickling reuses the process's attachment to the same
+    segment, so a worker handed the network with every task maps it once. The process that creates the segment
+    owns it and unlinks it on close or at exit; if that process dies first, Python's resource tracker unlinks it.
+    Attached processes only detach, on close or once the network is garbage collected (a process keeps the last
+    network it unpickled until it unpickles another), and leave nothing behind if they crash.
+    """
+
+    ARRAYS = MappedNetwork.ARRAYS
+
+    def __init__(self, name: str, layout: dict, meta: dict, segment: shared_memory.SharedMemory | None = None):
+        """
+        Attach to a segment written by SharedNetwork.create.
+        @param name: the segment name
+        @param layout: the byte offset and length of each array in the segment
+        @param meta: the sizes and weight class of the network
+        @param segment: the segment itself, in the process that created it
+        """
+        self.meta = meta
+        self.layout = layout
+        self._owner = segment is not None
+        self._segment = segment if segment is not None else shared_memory.SharedMemory(name, track=False)
+        self._maps = []
+        for array_name, (offset, length) in layout.items():
+            typecode = self.ARRAYS[array_name]
+            view = self._segment.buf[offset:offset + length * array(typecode).itemsize].cast(typecode)
+            self._maps.append((None, view))
+            setattr(self, array_name, view)
+        self.weight_class = tuple(meta["weight_class"])
+        self.forward = CSRGraph(self.indptr, self.indices)
+        self.reverse = CSRGraph(self.rindptr, self.rindices, self.redges)
+        # The segment can only be closed once the views into it are released, which the finalizer does first
+        self._detach = weakref.finalize(self, _detach_segment, self._segment, self._maps, self._owner)
+
+    __len__ = MappedNetwork.__len__
+    node_id = MappedNetwork.node_id
+    node_name = MappedNetwork.node_name
+
+    @classmethod
+    def create(cls, network) -> "SharedNetwork":
+        """
+        Copy a network into a new shared memory segment owned by this process.
+        @param network: a PreparedNetwork or MappedNetwork with string node names
+        """
+        names = [network.node_name(i).encode() for i in range(len(network))]
+        name_offsets = array("q", [0])
+        for encoded in names:
+            name_offsets.append(name_offsets[-1] + len(encoded))
+        arrays = {name: getattr(network, name) for name in ["indptr", "indices", "weights", "costs"]}
+        arrays.update({name: getattr(network, name) for name in ["rindptr", "rindices", "redges"]})
+        arrays["name_offsets"] = name_offsets
+        # Python orders strings by code point, which is also the order of their UTF-8 bytes
+        arrays["name_order"] = array("i", sorted(range(len(names)), key=names.__getitem__))
+        arrays["names"] = b"".join(names)
+
+        # Each array starts on an 8-byte boundary
+        layout = {}
+        size = 0
+        for name, values in arrays.items():
+            layout[name] = (size, len(values))
+            size += -(-len(values) * array(cls.ARRAYS[name]).itemsize // 8) * 8
+        segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, values in arrays.items():
+            offset, _ = layout[name]
+            data = memoryview(values).cast("B")
+            segment.buf[offset:offset + len(data)] = data
+            data.release()
+        meta = {"nodes": len(network), "edges": len(network.indices), "weight_class": list(network.weight_class)}
+        return cls(segment.name, layout, meta, segment)
+
+    @property
+    def handle(self) -> tuple[str, dict, dict]:
+        """The arguments that attach another process to this network"""
+        return self._segment.name, self.layout, self.meta
+
+    def __reduce__(self):
+        return _attach_shared_network, self.handle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Detach from the segment, and unlink it in the process that created it.
+        """
+        global _last_shared_network
+        if _shared_networks.get(self._segment.name) is self:
+            del _shared_networks[self._segment.name]
+        if _last_shared_network is self:
+            _last_shared_network = None
+        self._detach()
+
+
+# The networks attached by unpickling in this process, by segment name. They are held weakly, so a network
+# detaches once nothing uses it, except for the last one unpickled, which is kept so that a worker handed the same
+# network with every task maps it once.
+_shared_networks = weakref.WeakValueDictionary()
+_last_shared_network = None
+
+
+def _attach_shared_network(name: str, layout: dict, meta: dict) -> SharedNetwork:
+    global _last_shared_network
+    network = _shared_networks.get(name)
+    # Segment names can be reused once a segment is unlinked, so the layout has to match too
+    if network is None or network.layout != layout:
+        network = _shared_networks[name] = SharedNetwork(name, layout, meta)
+    _last_shared_network = network
+    return network
+
+
+def _detach_segment(segment: shared_memory.SharedMemory, maps: list, unlink: bool) -> None:
+    if unlink:
+        segment.unlink()
+    _close_maps(*maps)
+    segment.close()
+
+
+class _ArrayWriter:
+    """Append rows of values to raw array files, through in-memory buffers"""
+
+    def __init__(self, directory: Path, arrays: dict[str, str]):
+        self.files = [open(Path(directory, name), "wb") for name in arrays]
+        self.buffers = [array(typecode) for typecode in arrays.values()]
+
+    def append(self, *values) -> None:
+        for buffer, value in zip(self.buffers, values):
+            buffer.append(value)
+        if len(self.buffers[0]) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def extend(self, *values) -> None:
+        for buffer, value in zip(self.buffers, values):
+            buffer.extend(value)
+        if len(self.buffers[0]) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        for f, buffer in zip(self.files, self.buffers):
+            f.write(buffer)
+            del buffer[:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+        for f in self.files:
+            f.close()
+
+
+def _map_array(path: Path, typecode: str, length: int | None = None) -> tuple:
+    """
+    Memory-map a file of raw values. If length is given, a zeroed file of that many values is created and
+    mapped for writing, otherwise the file is mapped read-only.
+    @return the mmap (None for an empty file, which can not be mapped) and a memoryview of it as typecode
+    """
+    if length is not None:
+        with open(path, "wb") as f:
+            f.truncate(length * array(typecode).itemsize)
+    if path.stat().st_size == 0:
+        return None, memoryview(array(typecode))
+    with open(path, "r+b" if length is not None else "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if length is not None else mmap.ACCESS_READ)
+    return mapped, memoryview(mapped).cast(typecode)
+
+
+def _close_maps(*maps) -> None:
+    for mapped, view in maps:
+        view.release()
+        if mapped is not None:
+            mapped.close()
+
+
+def weight_costs(weights) -> array:
+    """The negative log transformed costs of edge weights, as in BTB_main"""
+    return array("d", (-math.log(w) if w > 0 else float("inf") for w in weights))
+
+
+def _row_starts(tails, n: int) -> array:
+    """The CSR indptr of edges with the given tails"""
+    starts = array("q", bytes(8 * (n + 1)))
+    for u in tails:
+        starts[u + 1] += 1
+    for u in range(n):
+        starts[u + 1] += starts[u]
+    return starts
+
+
+def _reverse_rows(indptr, indices, rindptr, rindices, redges) -> None:
+    """Fill rindices and redges with the reversed edges, with the tails of each node in node order"""
+    position = array("q", rindptr)
+    for u in range(len(indptr) - 1):
+        for e in range(indptr[u], indptr[u + 1]):
+            v = indices[e]
+            rindices[position[v]] = u
+            redges[position[v]] = e
+            position[v] += 1
+
+
+def _file_signature(path: Path) -> dict:
+    stat = Path(path).stat()
+    return {"path": str(Path(path).resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def current_rss() -> int | None:
+    """
+    @return the resident set size of this process in bytes, or None where /proc is not available
+    """
+    memory = resident_memory()
+    return None if memory is None else memory[0]
+
+
+def resident_memory() -> tuple[int, int] | None:
+    """
+    @return the resident set size of this process in bytes and how much of it is file-backed (including mapped
+    stores), or None where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            fields = f.read().split()
+    except OSError:
+        return None
+    return int(fields[1]) * mmap.PAGESIZE, int(fields[2]) * mmap.PAGESIZE
+
+
+def peak_rss() -> int | None:
+    """
+    @return the peak resident set size of this process in bytes, or None where it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kibibytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# functions for reusing the searches of an earlier run
+class SearchState:
+    """
+    The searches and path selections of a BowTieBuilder run, saved next to its output so that a run on a lightly
+    edited network only repeats the searches the edits can change. A search is reused when none of the nodes it
+    popped has a different neighbor order or edge cost, and the path selections of the earlier run are replayed up
+    to the first one that the changed distances between sources and targets can affect (see selection). The
+    pathway is the same as without a state.
+    """
+
+    VERSION = 2
+
+    def __init__(self, previous: dict | None = None):
+        """
+        @param previous: the saved state of the earlier run, if any
+        """
+        if previous is not None and previous.get("version") != self.VERSION:
+            previous = None
+        self.previous = previous
+        self.nodes = {}
+        self.signatures = {"forward": {}, "reverse": {}}
+        self.hidden = []
+        self.sources = []
+        self.targets = []
+        self.initial = {}
+        self.updates = {}
+        self.selections = []
+        self.replaying = False
+        self.changed = set()
+        self.diverged = False
+        self.replayed = 0
+        self.first_difference = None
+        self.reused = {"source": 0, "update": 0}
+        self.searched = {"source": 0, "update": 0}
+
+        # Searches of the earlier run, with their trees as indices into its node list
+        self._previous_nodes = []
+        self._previous_initial = {}
+        self._previous_updates = {}
+        self._affected = {"forward": set(), "reverse": set()}
+        if previous is not None:
+            self._previous_nodes = previous["nodes"]
+            self._previous_initial = previous["initial"]
+            self._previous_updates = {
+                (direction, source, tuple(targets)): (found, tree, entries)
+                for direction, source, targets, found, tree, entries in previous["updates"]
+            }
+
+    @classmethod
+    def load(cls, state_file: Path) -> "SearchState":
+        """
+        @param state_file: a file written by SearchState.save, which need not exist
+        @return the state, reusing the saved searches if there are any
+        """
+        if not Path(state_file).exists():
+            return cls()
+        with open(state_file, "r") as f:
+            return cls(json.load(f))
+
+    def save(self, state_file: Path) -> None:
+        state = {
+            "version": self.VERSION,
+            "nodes": list(self.nodes),
+            "signatures": self.signatures,
+            "hidden": self.hidden,
+            "sources": self.sources,
+            "targets": self.targets,
+            "initial": self.initial,
+            "updates": [
+                [direction, source, list(targets), found, tree, entries]
+                for (direction, source, targets), (found, tree, entries) in self.updates.items()
+            ],
+            "selections": self.selections,
+        }
+        # Write next to the state file and then replace it, so a failed run leaves the last state intact
+        partial = Path(state_file).with_name(Path(state_file).name + ".partial")
+        with open(partial, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+        partial.replace(state_file)
+
+    def set_network(self, network, network_reverse, compressed, compressed_reverse) -> None:
+        """
+        Fingerprint the network and find the nodes whose searches may differ from the earlier run.
+        @param network: the network, after the weight transformation and before compression
+        @param network_reverse: the same network with its edges reversed
+        @param compressed: the network that is searched, e.g. the result of compress_network
+        @param compressed_reverse: the reverse network that is searched
+        """
+        self.nodes = {u: k for k, u in enumerate(network)}
+        self.hidden = [u for u in network if u not in compressed._succ or u not in compressed_reverse._succ]
+        for direction, graph in [("forward", network), ("reverse", network_reverse)]:
+            self.signatures[direction] = {u: _adjacency_signature(nbrs) for u, nbrs in graph._succ.items()}
+        if self.previous is None:
+            return
+
+        previous_index = {u: k for k, u in enumerate(self._previous_nodes)}
+        hidden = set(self.previous["hidden"])
+        # A change of sources or targets can bring back a node compression dropped, without changing its edges
+        hidden_changed = hidden.symmetric_difference(self.hidden)
+        for direction, graph in [("forward", network), ("reverse", network_reverse)]:
+            old = self.previous["signatures"][direction]
+            new = self.signatures[direction]
+            stack = [u for u in new if old.get(u) != new[u] or u in hidden_changed] + [u for u in old if u not in new]
+            affected = set()
+            while stack:
+                u = stack.pop()
+                if u in affected:
+                    continue
+                affected.add(u)
+                # The earlier run only reached nodes it dropped or collapsed, and nodes it did not have,
+                # through their predecessors
+                if (u in hidden or u not in old) and u in graph._pred:
+                    stack.extend(graph._pred[u])
+            self._affected[direction] = {previous_index[u] for u in affected if u in previous_index}
+
+    def start(self, sources: list, targets: list) -> None:
+        self.sources = list(sources)
+        self.targets = list(targets)
+        self.replaying = (
+            self.previous is not None and self.previous["sources"] == self.sources
+            and self.previous["targets"] == self.targets
+        )
+        self.changed = set()
+        self.diverged = False
+
+    def initial_search(self, source, targets: list, search) -> tuple[dict, dict]:
+        """
+        The distances and paths from a source to the targets, from the earlier run if its search can be reused.
+        @param source: the source
+        @param targets: the targets
+        @param search: function with (source) input that searches from source and returns the distances and paths
+        @return the distances and paths of the targets that were reached
+        """
+        old = self._previous_initial.get(source)
+        if old is not None and self._reusable("forward", old["tree"]) and set(targets) <= set(old["targets"]):
+            self.reused["source"] += 1
+            val, path = old["dist"], old["paths"]
+            self.initial[source] = dict(old, tree=self._renumber(old["tree"]))
+            return val, path
+
+        self.searched["source"] += 1
+        val, path = search(source)
+        reached = [j for j in dict.fromkeys(targets) if j in val]
+        self.initial[source] = {
+            "tree": [self.nodes[u] for u in val],
+            "targets": list(dict.fromkeys(targets)),
+            "dist": {j: val[j] for j in reached},
+            "paths": {j: path[j] for j in reached},
+        }
+        # Note the entries of D that differ from the earlier run, see selection
+        for j in targets:
+            if old is None or (old["dist"].get(j), old["paths"].get(j)) != (
+                self.initial[source]["dist"].get(j), self.initial[source]["paths"].get(j)
+            ):
+                self.changed.add((source, j))
+        return val, path
+
+    def update_search(self, network, source, targets: list, D: dict, reverse=False) -> None:
+        """
+        Run update_D_multitarget, or repeat its effect on targets and D from the earlier run if that search can
+        be reused. The search only removes the first copy of each target it finds, so a target listed twice also
+        gets a finite entry in D, which is kept with the search.
+        """
+        # With no targets left the search changes nothing
+        if not targets:
+            return
+
+        direction = "reverse" if reverse else "forward"
+        key = (direction, source, tuple(targets))
+        if key in self.updates:
+            found, _, entries = self.updates[key]
+        elif key in self._previous_updates and self._reusable(direction, self._previous_updates[key][1]):
+            found, tree, entries = self._previous_updates[key]
+            self.updates[key] = (found, self._renumber(tree), entries)
+            self.reused["update"] += 1
+        else:
+            self.searched["update"] += 1
+            dist = update_D_multitarget(network, source, targets, D, reverse)
+            found = [v for v in dict.fromkeys(key[2]) if v in dist]
+            entries = {
+                target: D[(target, source) if reverse else (source, target)] for target in targets if target in dist
+            }
+            self.updates[key] = (found, [self.nodes[u] for u in dist], entries)
+            # Later selections depend on what this search left in D, see selection
+            previous = self._previous_updates.get(key)
+            if previous is None or (previous[0], previous[2]) != (found, entries):
+                self.diverged = True
+            return
+
+        for v in found:
+            targets.remove(v)
+        for target in targets:
+            value = [entries[target][0], list(entries[target][1])] if target in entries else [float("inf"), []]
+            if reverse:
+                D[(target, source)] = value
+            else:
+                D[(source, target)] = value
+
+    def selection(self, index: int, not_visited: list) -> list | None:
+        """
+        The path selection of iteration index of the earlier run, if it is sure to hold for this run. That is the
+        case while every earlier selection and update search had the same result, and none of the entries of D
+        from source searches that differ from the earlier run can still be a candidate. Such an entry stops being a
+        candidate once neither of its nodes is left in not_visited (nodes on a selected path are visited, but stay
+        in not_visited until they are an end of one).
+        Otherwise the selection is made as usual, and compared with the earlier one by record_selection.
+        @param index: the iteration
+        @param not_visited: the sources and targets not yet at the end of a selected path
+        @return the earlier selection, or None if it has to be made again
+        """
+        if not self.replaying or self.diverged or index > len(self.previous["selections"]):
+            return None
+        if self.changed:
+            not_visited = set(not_visited)
+            if any(a in not_visited or b in not_visited for a, b in self.changed):
+                return None
+        self.replayed += 1
+        return self.previous["selections"][index - 1]
+
+    def record_selection(self, index: int, selection: list) -> None:
+        self.selections.append(selection)
+        if not self.replaying:
+            return
+        previous = self.previous["selections"]
+        if index > len(previous) or previous[index - 1] != selection:
+            # From here on the runs differ, so none of the later selections can be replayed
+            self.replaying = False
+            self.first_difference = index
+
+    def report(self) -> None:
+        if self.previous is None:
+            print("No earlier search state, all searches were run")
+            return
+        print(
+            f"Reused {self.reused['source']} of {self.reused['source'] + self.searched['source']} source searches"
+            f" and {self.reused['update']} of {self.reused['update'] + self.searched['update']} update searches"
+        )
+        if self.previous["sources"] != self.sources or self.previous["targets"] != self.targets:
+            print("The sources or targets changed, so all path selections were made again")
+            return
+        print(f"Replayed {self.replayed} of {len(self.selections)} path selections")
+        if self.first_difference is not None:
+            print(f"Path selections differ from the earlier run from iteration {self.first_difference} on")
+
+    def _reusable(self, direction: str, tree: list) -> bool:
+        return self._affected[direction].isdisjoint(tree)
+
+    def _renumber(self, tree: list) -> list:
+        """Translate the indices of a reused tree from the earlier node list to this one"""
+        return [self.nodes[self._previous_nodes[k]] for k in tree]
+
+
+def _adjacency_signature(nbrs: dict) -> str:
+    """A stable hash of a node's neighbors in order and the costs of the edges to them"""
+    return hashlib.blake2b(
+        repr([(v, data.get("weight", 1)) for v, data in nbrs.items()]).encode(), digest_size=8
+    ).hexdigest()
+
+
 def update_D(network: nx.DiGraph, i: str, j: str, D: dict) -> None:
     # check if there is a path between i and j
     if nx.has_path(network, i, j):
@@ -183,11 +1397,12 @@ def update_D(network: nx.DiGraph, i: str, j: str, D: dict) -> None:
         D[(i, j)] = [float("inf"), []]
         # print(f"There is no path between {i} and {j}")
 
-def update_D_multitarget(network: nx.DiGraph, source: str, targets: list[str], D: dict, reverse=False) -> None:
+def update_D_multitarget(network: nx.DiGraph, source: str, targets: list[str], D: dict, reverse=False) -> dict:
     # adapted from multi_source_dijkstra
     paths = {source: [source]}
-    weight = lambda u, v, data: data.get(weight, 1)
-    dist = dijkstra_multisource_multitarget(network, {source}, weight, paths=paths, targets=targets)
+    # The weight function this search always had looked itself up in each edge's data and fell back to 1, so
+    # every edge costs 1 here whatever its weight
+    dist = bfs_multisource_multitarget(network, {source}, 1, paths=paths, targets=targets)
 
     for target in targets:
         if target in dist:
@@ -203,6 +1418,7 @@ def update_D_multitarget(network: nx.DiGraph, source: str, targets: list[str], D
             else:
                 D[(source, target)] = [float("inf"), []]
             # print(f"There is no path between {i} and {j}")
+    return dist
 
 def add_path_to_P(path: list, P: nx.DiGraph) -> None:
     for i in range(len(path) - 1):
@@ -266,18 +1482,9 @@ def check_not_visited_not_visited(not_visited: list, D: dict) -> tuple:
                         current_t = not_visited[i]
     return current_path, current_s, current_t, min_value
 
-def BTB_main(network: nx.DiGraph, sources: list, targets: list) -> nx.DiGraph:
-    # We do this to do avoid re-implementing a reverse multi-target dijkstra. TODO: This is more
-    # expensive on memory. Also see an issue on why we needed to implement a multi-target dijkstra:
-    # https://github.com/networkx/networkx/issues/703.
-    network_reverse = network.reverse()
-    
-    # P is the returned pathway
-    P = nx.DiGraph()
-
-    P.add_nodes_from(sources)
-    P.add_nodes_from(targets)
-
+def BTB_main(
+    network: nx.DiGraph, sources: list, targets: list, compress: bool = True, state: SearchState | None = None
+) -> nx.DiGraph:
     weights = {}
     if not nx.is_weighted(network):
         # Set all weights to 1 if the network is unweighted
@@ -300,6 +1507,57 @@ def BTB_main(network: nx.DiGraph, sources: list, targets: list) -> nx.DiGraph:
         nx.set_edge_attributes(network, values=updated_weights, name="weight")
         # print(f'Original Weights: {weights}')
         # print(f'Transformed Weights: {updated_weights}')
+        del updated_weights
+    del weights
+
+    # We do this to do avoid re-implementing a reverse multi-target dijkstra. TODO: This is more
+    # expensive on memory. Also see an issue on why we needed to implement a multi-target dijkstra:
+    # https://github.com/networkx/networkx/issues/703.
+    network_reverse = network.reverse()
+
+    # Collapse the parts of the network that searches between sources and targets only pass through.
+    # Paths are expanded back to the original nodes, so P is the same as without compression.
+    # Both directions are compressed on their own to keep the neighbor order of the reversed network.
+    # Each uncompressed graph is released once it is compressed, unless the state still has to fingerprint it
+    # (the forward one only if the caller holds no reference to it either, as run_memory does).
+    if compress and state is None:
+        network_reverse = compress_network(network_reverse, sources + targets)
+        network = compress_network(network, sources + targets)
+    elif compress:
+        compressed_reverse = compress_network(network_reverse, sources + targets)
+        compressed = compress_network(network, sources + targets)
+        state.set_network(network, network_reverse, compressed, compressed_reverse)
+        network, network_reverse = compressed, compressed_reverse
+        del compressed, compressed_reverse
+    elif state is not None:
+        state.set_network(network, network_reverse, network, network_reverse)
+
+    # Pick the search that suits the edge costs, e.g. breadth-first search when they are all the same
+    weight = lambda u, v, data: data.get("weight", 1)
+    weight_class = classify_weights(network, weight)
+
+    return build_pathway(network, network_reverse, sources, targets, weight, weight_class, state)
+
+
+def build_pathway(
+    network, network_reverse, sources: list, targets: list, weight, weight_class, state: SearchState | None = None
+) -> nx.DiGraph:
+    """
+    Run the BowTieBuilder steps on a network whose weights have already been transformed into costs.
+    @param network: the network to search, a NetworkX graph or a CSRGraph
+    @param network_reverse: the same network with its edges reversed
+    @param sources: the sources
+    @param targets: the targets
+    @param weight: function with (u, v, data) input that returns that edge's cost
+    @param weight_class: the result of classify_weights for the network and weight
+    @param state: the SearchState to record the searches in, and reuse those of an earlier run from
+    @return the pathway P
+    """
+    # P is the returned pathway
+    P = nx.DiGraph()
+
+    P.add_nodes_from(sources)
+    P.add_nodes_from(targets)
 
     # Step 1
     # Initialize the pathway P with all nodes S union T, and flag all nodes in S union T as 'not visited'.
@@ -314,11 +1572,19 @@ def BTB_main(network: nx.DiGraph, sources: list, targets: list) -> nx.DiGraph:
     # D is the distance matrix
     # Format
     D = {}
+
+    def search(i):
+        # The search stops once it has found every target, the only nodes D needs, unless a cost is negative
+        path = {i: [i]}
+        return multisource_multitarget(network, {i}, weight, weight_class, paths=path, targets=list(targets)), path
+
+    if state is not None:
+        state.start(sources, targets)
     for i in sources:
         # run a single_source_dijsktra to find the shortest path from source to every other nodes
         # val is the shortest distance from source to every other nodes
         # path is the shortest path from source to every other nodes
-        val, path = nx.single_source_dijkstra(network, i)
+        val, path = search(i) if state is None else state.initial_search(i, targets, search)
         for j in targets:
             # if there is a path between i and j, then add the distance and the path to D
             if j in val:
@@ -346,12 +1612,24 @@ def BTB_main(network: nx.DiGraph, sources: list, targets: list) -> nx.DiGraph:
         current_t = ""
 
         # First checking whether there exists a path from visited nodes to not visited nodes or vise versa
-        current_path, current_s, current_t, min_value = check_visited_not_visited(
-            visited, not_visited, D
-        )
+        selection = None if state is None else state.selection(index, not_visited)
+        if selection is None:
+            current_path, current_s, current_t, min_value = check_visited_not_visited(
+                visited, not_visited, D
+            )
+            from_visited = min_value != float("inf")
+            if not from_visited:
+                current_path, current_s, current_t, min_value = (
+                    check_not_visited_not_visited(not_visited, D)
+                )
+            if state is not None:
+                state.record_selection(index, [from_visited, current_path, current_s, current_t, min_value])
+        else:
+            from_visited, current_path, current_s, current_t, min_value = selection
+            state.record_selection(index, selection)
 
         # if such a path exists, then we need to update D and P
-        if min_value != float("inf"):
+        if from_visited:
             # Set the distance to infinity
             D[(current_s, current_t)] = [float("inf"), []]
 
@@ -367,9 +1645,6 @@ def BTB_main(network: nx.DiGraph, sources: list, targets: list) -> nx.DiGraph:
 
         # If such path doesn't exist, then we find a path from a not-visited node to a not-visited node
         else:
-            current_path, current_s, current_t, min_value = (
-                check_not_visited_not_visited(not_visited, D)
-            )
             # If such a path exists, then we need to update D and P
             if min_value != float("inf"):
                 D[(current_s, current_t)] = [float("inf"), []]
@@ -391,8 +1666,12 @@ def BTB_main(network: nx.DiGraph, sources: list, targets: list) -> nx.DiGraph:
         for i in current_path:
             if i not in sources_targets:
                 # Since D is a matrix from Source to Target, we need to update the distance from source to i and from i to target
-                update_D_multitarget(network_reverse, i, sources, D, reverse=True)
-                update_D_multitarget(network, i, targets, D)
+                if state is None:
+                    update_D_multitarget(network_reverse, i, sources, D, reverse=True)
+                    update_D_multitarget(network, i, targets, D)
+                else:
+                    state.update_search(network_reverse, i, sources, D, reverse=True)
+                    state.update_search(network, i, targets, D)
                 # Update the distance from i to i
                 D[(i, i)] = [float("inf"), []]
 
@@ -413,6 +1692,69 @@ def BTB_main(network: nx.DiGraph, sources: list, targets: list) -> nx.DiGraph:
     return P
 
 
+def BTB_csr(
+    network, sources: list[str], targets: list[str], costs=None, weight_class: tuple | None = None
+) -> nx.DiGraph:
+    """
+    Run BowTieBuilder on a network stored as compressed sparse rows. The result is the same as BTB_main on the
+    NetworkX graph of the same edges.
+    @param network: a MappedNetwork, PreparedNetwork or SharedNetwork
+    @param sources: the source names
+    @param targets: the target names
+    @param costs: the cost of each edge, by forward edge index, to search with instead of network.costs
+    @param weight_class: the result of classify_costs for costs, which is computed if not given
+    @return the pathway P, with node names
+    """
+    # Terminals without edges are numbered after the stored nodes, in the order NetworkX would add them
+    names = {}
+    ids = {}
+
+    def node_id(name):
+        if name not in ids:
+            i = network.node_id(name)
+            if i is None:
+                i = len(network) + len(names)
+                names[i] = name
+            ids[name] = i
+        return ids[name]
+
+    source_ids = [node_id(name) for name in sources]
+    target_ids = [node_id(name) for name in targets]
+    if network.meta["edges"] == 0:
+        print("Original Network is unweighted. All weights set to 1.")
+
+    if costs is None:
+        costs, weight_class = network.costs, network.weight_class
+    elif weight_class is None:
+        weight_class = classify_costs(costs)
+    P = build_pathway(
+        network.forward, network.reverse, source_ids, target_ids, lambda u, v, e: costs[e], weight_class
+    )
+    return nx.relabel_nodes(P, {i: names[i] if i in names else network.node_name(i) for i in P})
+
+
+def bowtiebuilder(
+    network, sources, targets, node_ids: bool = False
+) -> tuple[list, list] | tuple[array, array]:
+    """
+    Run BowTieBuilder from Python, without reading or writing files.
+    @param network: a PreparedNetwork, MappedNetwork or SharedNetwork, or an iterable of edge tuples to prepare one from (see
+    PreparedNetwork). Prepare the network once to reuse it across runs.
+    @param sources: sequence of source names
+    @param targets: sequence of target names
+    @param node_ids: return the edges as node IDs of the network instead of node names
+    @return the first and second nodes of the pathway's edges, as lists of names or arrays of node IDs
+    """
+    if not isinstance(network, (PreparedNetwork, MappedNetwork, SharedNetwork)):
+        network = PreparedNetwork(network)
+    P = BTB_csr(network, list(sources), list(targets))
+    tails = [u for u, _ in P.edges]
+    heads = [v for _, v in P.edges]
+    if node_ids:
+        return array("q", map(network.node_id, tails)), array("q", map(network.node_id, heads))
+    return tails, heads
+
+
 def write_output(output_file, P):
     with open(output_file, "w") as f:
         f.write("Node1" + "\t" + "Node2" + "\n")
@@ -420,13 +1762,40 @@ def write_output(output_file, P):
             f.write(edge[0] + "\t" + edge[1] + "\n")
 
 
-def btb_wrapper(edges: Path, sources_path: Path, targets_path: Path, output_file: Path):
+def btb_wrapper(
+    edges: Path,
+    sources_path: Path,
+    targets_path: Path,
+    output_file: Path,
+    storage: str = "memory",
+    store_dir: Path | None = None,
+    max_rss: float | None = None,
+    benchmark: bool = False,
+    incremental: bool = False,
+    ensemble: int | None = None,
+    perturbation: str = "lognormal",
+    noise: float = 0.1,
+    seed: int = 0,
+    workers: int | None = None,
+):
     """
     Run BowTieBuilder pathway reconstruction.
     @param edges: Path to the edge file
     @param sources: Path to the source file
     @param targets: Path to the source file
     @param output_file: Path to the output file that will be written
+    @param storage: "memory" to load the network as a NetworkX graph, or "mmap" to search it in memory-mapped files
+    @param store_dir: Directory for the memory-mapped files, built from the edge file when missing or outdated
+    @param max_rss: Resident memory limit in MiB for mmap storage, see MappedNetwork.check_memory
+    @param benchmark: Run with both storage modes and report the relative throughput
+    @param incremental: Reuse the searches saved next to the output file by the last run, and save those of this
+    run
+    @param ensemble: Run this many replicates with perturbed weights, with the network in shared memory or, with
+    mmap storage, in store_dir; see run_ensemble. output_file gets the fraction of replicates each edge is in.
+    @param perturbation: The perturbation model of the ensemble, see perturb_costs
+    @param noise: The scale of the perturbation
+    @param seed: The seed of the ensemble
+    @param workers: The number of processes running the ensemble
     """
     if not edges.exists():
         raise OSError(f"Edges file {str(edges)} does not exist")
@@ -434,20 +1803,234 @@ def btb_wrapper(edges: Path, sources_path: Path, targets_path: Path, output_file
         raise OSError(f"Sources file {str(sources_path)} does not exist")
     if not targets_path.exists():
         raise OSError(f"Targets file {str(targets_path)} does not exist")
+    if storage not in ["memory", "mmap"]:
+        raise ValueError(f"Unknown storage {storage}, expected memory or mmap")
+    if incremental and (storage != "memory" or benchmark):
+        raise ValueError("Incremental runs need memory storage")
+    if ensemble is not None and (incremental or benchmark):
+        raise ValueError("Ensembles can not be run incrementally or benchmarked")
+    if max_rss is not None and storage != "mmap" and not benchmark:
+        raise ValueError("max_rss only applies to mmap storage")
 
     if output_file.exists():
         print(f"Output files {str(output_file)} (nodes) will be overwritten")
 
     # Create the parent directories for the output file if needed
     output_file.parent.mkdir(parents=True, exist_ok=True)
+    if store_dir is None:
+        store_dir = Path(output_file.parent, f"{edges.name}.csr")
+
+    if ensemble is not None:
+        run_ensemble(
+            edges, sources_path, targets_path, output_file, store_dir, ensemble, perturbation, noise, seed, workers,
+            max_rss, storage,
+        )
+        return
+    if benchmark:
+        output_graph = benchmark_storage(edges, sources_path, targets_path, store_dir, max_rss)
+    elif storage == "mmap":
+        output_graph = run_mapped(edges, sources_path, targets_path, store_dir, max_rss)[0]
+    elif incremental:
+        state_file = Path(output_file.parent, f"{output_file.name}.state.json")
+        state = SearchState.load(state_file)
+        output_graph = run_memory(edges, sources_path, targets_path, state)[0]
+        state.report()
+        state.save(state_file)
+    else:
+        output_graph = run_memory(edges, sources_path, targets_path)[0]
+
+    write_output(output_file, output_graph)
 
-    edge_list = read_edges(edges)
+
+def run_memory(
+    edges: Path, sources_path: Path, targets_path: Path, state: SearchState | None = None
+) -> tuple[nx.DiGraph, float, float]:
+    """
+    Run BowTieBuilder on a NetworkX graph.
+    @param state: the SearchState to record the searches in, and reuse those of an earlier run from
+    @return the pathway, the seconds spent loading the network and the seconds spent running BowTieBuilder
+    """
+    start = time.perf_counter()
     sources, targets = read_source_target(sources_path, targets_path)
-    network = construct_network(edge_list, sources, targets)
+    networks = [construct_network(read_edges(edges), sources, targets)]
+    loaded = time.perf_counter()
 
-    output_graph = BTB_main(network, sources, targets)
+    # Hand the only reference to BTB_main, so the uncompressed network is freed once it is compressed
+    output_graph = BTB_main(networks.pop(), sources, targets, state=state)
+    return output_graph, loaded - start, time.perf_counter() - loaded
 
-    write_output(output_file, output_graph)
+
+def run_mapped(
+    edges: Path, sources_path: Path, targets_path: Path, store_dir: Path, max_rss: float | None = None
+) -> tuple[nx.DiGraph, float, float]:
+    """
+    Run BowTieBuilder on a MappedNetwork.
+    @param max_rss: Resident memory limit in MiB, see MappedNetwork.check_memory
+    @return the pathway, the seconds spent loading (and if needed building) the store and the seconds spent
+    running BowTieBuilder
+    """
+    start = time.perf_counter()
+    sources, targets = read_source_target(sources_path, targets_path)
+    network = MappedNetwork.from_edges(edges, store_dir, None if max_rss is None else int(max_rss * 2**20))
+    loaded = time.perf_counter()
+
+    try:
+        output_graph = BTB_csr(network, sources, targets)
+    finally:
+        network.close()
+    return output_graph, loaded - start, time.perf_counter() - loaded
+
+
+def benchmark_storage(
+    edges: Path, sources_path: Path, targets_path: Path, store_dir: Path, max_rss: float | None = None
+) -> nx.DiGraph:
+    """
+    Run BowTieBuilder with memory-mapped and in-memory storage, check they give the same pathway and print the
+    time, peak memory and relative throughput of each. The memory-mapped run goes first, as peak memory only grows.
+    @return the pathway
+    """
+    mapped_graph, mapped_load, mapped_run = run_mapped(edges, sources_path, targets_path, store_dir, max_rss)
+    mapped_peak = peak_rss()
+    memory_graph, memory_load, memory_run = run_memory(edges, sources_path, targets_path)
+    memory_peak = peak_rss()
+    if list(mapped_graph.edges) != list(memory_graph.edges):
+        raise RuntimeError("Memory-mapped and in-memory storage gave different pathways")
+
+    def peak(rss):
+        return "unknown" if rss is None else f"{rss / 2**20:.1f} MiB"
+
+    print(f"mmap:   load {mapped_load:.3f} s, BowTieBuilder {mapped_run:.3f} s, peak RSS {peak(mapped_peak)}")
+    print(f"memory: load {memory_load:.3f} s, BowTieBuilder {memory_run:.3f} s, peak RSS {peak(memory_peak)}")
+    print(f"mmap throughput relative to memory: {memory_run / mapped_run if mapped_run else float('inf'):.2f}")
+    return memory_graph
+
+
+# functions for running an ensemble of replicates with perturbed weights
+PERTURBATIONS = ["lognormal", "uniform"]
+
+
+def perturb_costs(costs, model: str, noise: float, seed: str) -> array:
+    """
+    Draw perturbed edge costs. The noise is added to the negative log transformed costs, so a weight w becomes
+    w * exp(noise * N(0, 1)) under "lognormal", and a cost that would fall below 0 (a weight above 1) is reflected
+    back, rather than clipped, so that weights of 1 are perturbed as much as any other. No finite cost becomes
+    infinite, so no edge is removed from a replicate.
+    @param costs: the cost of each edge, see weight_costs
+    @param model: "lognormal" to add noise * N(0, 1) to each cost, or "uniform" to add U(-noise, noise)
+    @param noise: the scale of the perturbation
+    @param seed: the seed of the draws, so that a replicate is the same whichever process runs it
+    @return the perturbed costs
+    """
+    rng = random.Random(seed)
+    if model == "lognormal":
+        perturbed = (c + noise * rng.gauss(0, 1) for c in costs)
+    elif model == "uniform":
+        perturbed = (c + rng.uniform(-noise, noise) for c in costs)
+    else:
+        raise ValueError(f"Unknown perturbation {model}, expected one of {', '.join(PERTURBATIONS)}")
+    return array("d", (abs(c) for c in perturbed))
+
+
+def run_ensemble(
+    edges: Path,
+    sources_path: Path,
+    targets_path: Path,
+    output_file: Path,
+    store_dir: Path,
+    replicates: int,
+    perturbation: str = "lognormal",
+    noise: float = 0.1,
+    seed: int = 0,
+    workers: int | None = None,
+    max_rss: float | None = None,
+    storage: str = "memory",
+) -> dict:
+    """
+    Run BowTieBuilder replicates with perturbed weights in parallel. The network is indexed once, into a
+    SharedNetwork or a MappedNetwork, which every worker attaches to or maps, so the processes share one copy of
+    the graph and only hold their own costs. Each replicate's pathway is written to <output_file stem>-replicates/replicate-<r>.txt, and output_file gets
+    the fraction of replicates each edge is in.
+    @param replicates: the number of replicates
+    @param perturbation: the perturbation model, see perturb_costs
+    @param noise: the scale of the perturbation
+    @param seed: the seed of the ensemble; replicate r draws its weights from "<seed>-<r>"
+    @param workers: the number of worker processes (default: one per CPU)
+    @param max_rss: Resident memory limit in MiB for each worker with mmap storage, see MappedNetwork.check_memory
+    @param storage: "memory" to hold the network in shared memory, or "mmap" to map the store in store_dir
+    @return the number of replicates each edge of the pathways is in
+    """
+    if replicates < 1:
+        raise ValueError(f"The ensemble needs at least one replicate, got {replicates}")
+    if perturbation not in PERTURBATIONS:
+        raise ValueError(f"Unknown perturbation {perturbation}, expected one of {', '.join(PERTURBATIONS)}")
+    sources, targets = read_source_target(sources_path, targets_path)
+    replicate_dir = Path(output_file.parent, f"{output_file.stem}-replicates")
+    replicate_dir.mkdir(parents=True, exist_ok=True)
+
+    workers = min(workers or os.process_cpu_count() or 1, replicates)
+    jobs = [(r, sources, targets, perturbation, noise, f"{seed}-{r}") for r in range(replicates)]
+    frequencies = {}
+
+    def add_replicates(pathways):
+        for r, P in pathways:
+            write_output(Path(replicate_dir, f"replicate-{r}.txt"), P)
+            for edge in P.edges:
+                frequencies[edge] = frequencies.get(edge, 0) + 1
+
+    shared = None
+    if storage == "mmap":
+        MappedNetwork.from_edges(edges, store_dir).close()
+        initargs = (MappedNetwork, store_dir, None if max_rss is None else int(max_rss * 2**20))
+    else:
+        shared = SharedNetwork.create(PreparedNetwork(iter_edges(edges)))
+        initargs = (SharedNetwork, *shared.handle)
+    try:
+        if workers == 1:
+            _open_ensemble_network(*initargs)
+            try:
+                add_replicates(map(_run_replicate, jobs))
+            finally:
+                _close_ensemble_network()
+        else:
+            with multiprocessing.Pool(workers, _open_ensemble_network, initargs) as pool:
+                add_replicates(pool.imap(_run_replicate, jobs))
+    finally:
+        if shared is not None:
+            shared.close()
+
+    write_frequencies(output_file, frequencies, replicates)
+    return frequencies
+
+
+# The network of an ensemble worker process, opened by _open_ensemble_network
+_ensemble_network = None
+
+
+def _open_ensemble_network(network_class, *args) -> None:
+    global _ensemble_network
+    _ensemble_network = network_class(*args)
+
+
+def _close_ensemble_network() -> None:
+    global _ensemble_network
+    _ensemble_network.close()
+    _ensemble_network = None
+
+
+def _run_replicate(job: tuple) -> tuple[int, nx.DiGraph]:
+    r, sources, targets, perturbation, noise, seed = job
+    costs = perturb_costs(_ensemble_network.costs, perturbation, noise, seed)
+    return r, BTB_csr(_ensemble_network, sources, targets, costs)
+
+
+def write_frequencies(output_file: Path, frequencies: dict, replicates: int) -> None:
+    """
+    Write the fraction of replicates each edge is in, from the most frequent edge down.
+    """
+    with open(output_file, "w") as f:
+        f.write("Node1" + "\t" + "Node2" + "\t" + "Frequency" + "\n")
+        for (u, v), n in sorted(frequencies.items(), key=lambda item: -item[1]):
+            f.write(u + "\t" + v + "\t" + str(n / replicates) + "\n")
 
 
 def main():
@@ -458,7 +2041,22 @@ def main():
 
     # path length - l
     # test_mode - default to be false
-    btb_wrapper(args.edges, args.sources, args.targets, args.output_file)
+    btb_wrapper(
+        args.edges,
+        args.sources,
+        args.targets,
+        args.output_file,
+        storage=args.storage,
+        store_dir=args.store_dir,
+        max_rss=args.max_rss,
+        benchmark=args.benchmark,
+        incremental=args.incremental,
+        ensemble=args.ensemble,
+        perturbation=args.perturbation,
+        noise=args.noise,
+        seed=args.seed,
+        workers=args.workers,
+    )
 
 
 if __name__ == "__main__":
@@ -1,12 +1,35 @@
 # import sys
+import gc
+import multiprocessing
+import pickle
+import sys
 from filecmp import cmp
+from multiprocessing import shared_memory
 from pathlib import Path
 
 import pytest
 
 # TODO consider refactoring to simplify the import
 # Modify the path because of the - in the directory
-from btb import btb_wrapper
+import btb
+from btb import (
+    BTB_csr,
+    BTB_main,
+    MappedNetwork,
+    PreparedNetwork,
+    SharedNetwork,
+    bowtiebuilder,
+    btb_wrapper,
+    classify_weights,
+    compress_network,
+    construct_network,
+    dijkstra_multisource_multitarget,
+    multisource_multitarget,
+    perturb_costs,
+    read_edges,
+    read_source_target,
+    weight_costs,
+)
 
 TEST_DIR = Path("test")
 OUT_FILE = Path(TEST_DIR, "output", "output.txt")
@@ -26,6 +49,12 @@ NO_WEIGHT_OUT_FILE = Path(TEST_DIR, "output", "no-weight-output.txt")
 WEIGHT_ONE_OUT_FILE = Path(TEST_DIR, "output", "weight-one-output.txt")
 
 
+def mapped_segments() -> list[str]:
+    """The names of the shared memory segments this process maps, once per mapping"""
+    with open("/proc/self/maps", "r") as f:
+        return [Path(line.split()[5]).name for line in f if len(line.split()) > 5 and "/psm_" in line]
+
+
 class TestBowTieBuilder:
     """
     Run the BowTieBuilder algorithm on the example input files and check the output matches the expected output
@@ -349,3 +378,423 @@ class TestBowTieBuilder:
         assert output_content == expected_content, (
             "Output file does not match expected output file"
         )
+
+    """
+    Compress a network with a chain and dangling nodes and check that searches walk the chain back out
+    """
+
+    def test_compress_network(self):
+        network = construct_network(
+            [
+                ("S1", "A", 0.0),
+                ("A", "B", 0.0),
+                ("B", "T1", 0.0),
+                ("S1", "C", 0.0),
+                ("C", "D", 0.0),
+                ("D", "C", 0.0),
+                ("E", "T1", 0.0),
+            ],
+            ["S1"],
+            ["T1"],
+        )
+        compressed = compress_network(network, ["S1", "T1"])
+        assert set(compressed.nodes) == {"S1", "T1"}
+        assert list(compressed.edges) == [("S1", "T1")]
+
+        paths = {"S1": ["S1"]}
+        dist = dijkstra_multisource_multitarget(compressed, {"S1"}, lambda u, v, data: 1, paths=paths)
+        assert dist["T1"] == 3
+        assert paths["T1"] == ["S1", "A", "B", "T1"]
+
+    """
+    Run the BowTieBuilder algorithm with and without network compression and check the pathways are identical
+    """
+
+    @pytest.mark.parametrize(
+        "edges",
+        [
+            "btb-edges.txt",
+            "bidirectional-edges.txt",
+            "disjoint2-edges.txt",
+            "loop-edges.txt",
+            "source-to-source-edges.txt",
+            "weighted-edges.txt",
+        ],
+    )
+    def test_compress_identical(self, edges):
+        pathways = []
+        for compress in [False, True]:
+            sources, targets = read_source_target(
+                Path(TEST_DIR, "input", "btb-sources.txt"), Path(TEST_DIR, "input", "btb-targets.txt")
+            )
+            network = construct_network(read_edges(Path(TEST_DIR, "input", edges)), sources, targets)
+            pathways.append(list(BTB_main(network, sources, targets, compress=compress).edges))
+        assert pathways[0] == pathways[1]
+
+    """
+    Classify the edge costs of the example networks to pick a search
+    """
+
+    @pytest.mark.parametrize(
+        "weights, expected",
+        [
+            ([1, 1, 1], ("uniform", 1)),
+            ([0.5, 0.5, 0.5], ("uniform", 0.5)),
+            ([0, 2, 1], ("general", None)),
+            ([0.5, 1, 1], ("general", None)),
+            ([-1, 1, 1], ("negative", None)),
+        ],
+    )
+    def test_classify_weights(self, weights, expected):
+        network = construct_network(
+            [("S1", "A", weights[0]), ("A", "T1", weights[1]), ("S1", "T1", weights[2])], [], []
+        )
+        assert classify_weights(network, lambda u, v, data: data["weight"]) == expected
+
+    """
+    Run the BowTieBuilder algorithm on a network with a weight above 1, whose negative cost makes Dijkstra's
+    algorithm find contradictory paths once it searches past the target
+    """
+
+    def test_negative_costs(self):
+        edges = [("S1", "A", 1.0), ("S1", "B", 0.5), ("B", "A", 4.0)]
+        with pytest.raises(ValueError, match="Contradictory paths"):
+            BTB_main(construct_network(edges, ["S1"], ["A"]), ["S1"], ["A"])
+        with pytest.raises(ValueError, match="Contradictory paths"):
+            bowtiebuilder(PreparedNetwork(edges), ["S1"], ["A"])
+
+    """
+    Run breadth-first search on the example networks and check it matches Dijkstra's algorithm
+    """
+
+    @pytest.mark.parametrize("edges", ["btb-edges.txt", "bidirectional-edges.txt", "loop-edges.txt"])
+    @pytest.mark.parametrize("weight", [lambda u, v, data: 1, lambda u, v, data: 0])
+    def test_breadth_first_search(self, edges, weight):
+        network = construct_network(read_edges(Path(TEST_DIR, "input", edges)), [], [])
+        weight_class = classify_weights(network, weight)
+        assert weight_class[0] == "uniform"
+        for source in network:
+            expected_pred, expected_paths = {source: []}, {source: [source]}
+            expected = dijkstra_multisource_multitarget(
+                network, {source}, weight, pred=expected_pred, paths=expected_paths
+            )
+            pred, paths = {source: []}, {source: [source]}
+            dist = multisource_multitarget(network, {source}, weight, weight_class, pred=pred, paths=paths)
+            assert list(dist.items()) == list(expected.items())
+            assert paths == expected_paths
+            assert pred == expected_pred
+
+    """
+    Run the BowTieBuilder algorithm on memory-mapped storage and check the output matches the expected output
+    """
+
+    @pytest.mark.parametrize(
+        "edges, expected",
+        [
+            ("btb-edges.txt", "btb-output.txt"),
+            ("bidirectional-edges.txt", "bidirectional-output.txt"),
+            ("disjoint2-edges.txt", "disjoint-output.txt"),
+            ("loop-edges.txt", "loop-output.txt"),
+            ("weight-one-edges.txt", "weighted-output.txt"),
+        ],
+    )
+    def test_mmap_storage(self, edges, expected):
+        out_file = Path(TEST_DIR, "output", "mmap", edges)
+        out_file.unlink(missing_ok=True)
+        sources_path = Path(TEST_DIR, "input", "disjoint-sources.txt" if "disjoint" in edges else "btb-sources.txt")
+        targets_path = Path(TEST_DIR, "input", "disjoint-targets.txt" if "disjoint" in edges else "btb-targets.txt")
+        btb_wrapper(
+            edges=Path(TEST_DIR, "input", edges),
+            sources_path=sources_path,
+            targets_path=targets_path,
+            output_file=out_file,
+            storage="mmap",
+        )
+        assert out_file.exists(), "Output file was not written"
+
+        with open(out_file, "r") as output_file:
+            output_content = set(output_file.read().splitlines())
+        with open(Path(TEST_DIR, "expected_output", expected), "r") as expected_output_file:
+            expected_content = set(expected_output_file.read().splitlines())
+        assert output_content == expected_content, "Output file does not match expected output file"
+
+    """
+    Searching a memory-mapped network above max_rss warns once that the limit could not be met, and gives the
+    same pathway
+    """
+
+    @pytest.mark.skipif(btb.resident_memory() is None, reason="needs /proc/self/statm")
+    def test_memory_limit(self, monkeypatch, capsys):
+        store_dir = Path(TEST_DIR, "output", "memory-limit")
+        MappedNetwork.build(Path(TEST_DIR, "input", "btb-edges.txt"), store_dir)
+        sources, targets = read_source_target(
+            Path(TEST_DIR, "input", "btb-sources.txt"), Path(TEST_DIR, "input", "btb-targets.txt")
+        )
+        network = MappedNetwork(store_dir)
+        expected = BTB_csr(network, sources, targets)
+        network.close()
+
+        network = MappedNetwork(store_dir, max_rss=2**50)
+        network.check_memory()
+        assert not network.over_limit
+        assert capsys.readouterr().err == ""
+        network.close()
+
+        monkeypatch.setattr(btb, "MEMORY_CHECK_INTERVAL", 1)
+        network = MappedNetwork(store_dir, max_rss=2**20)
+        try:
+            P = BTB_csr(network, sources, targets)
+        finally:
+            network.close()
+        assert network.over_limit
+        assert capsys.readouterr().err.count("above max_rss") == 1
+        assert list(P.edges) == list(expected.edges)
+
+    """
+    Build a memory-mapped network and look up its nodes and edges
+    """
+
+    def test_mapped_network(self):
+        store_dir = Path(TEST_DIR, "output", "mapped-network")
+        MappedNetwork.build(Path(TEST_DIR, "input", "loop-edges.txt"), store_dir)
+        network = MappedNetwork(store_dir)
+        try:
+            nodes = [network.node_name(i) for i in range(len(network))]
+            assert [network.node_id(name) for name in nodes] == list(range(len(network)))
+            assert network.node_id("missing") is None
+
+            expected = construct_network(read_edges(Path(TEST_DIR, "input", "loop-edges.txt")), [], [])
+            assert nodes == list(expected.nodes)
+            edges = [
+                (nodes[u], nodes[network.indices[e]], network.weights[e])
+                for u in range(len(network))
+                for e in range(network.indptr[u], network.indptr[u + 1])
+            ]
+            assert edges == list(expected.edges(data="weight"))
+        finally:
+            network.close()
+
+    """
+    Rerun with the saved search state after editing the edges file, and check the pathway is the same as a run
+    without it
+    """
+
+    @pytest.mark.parametrize(
+        "edges, edit",
+        [
+            ("btb-edges.txt", "S2\tT1\t1"),
+            ("btb-edges.txt", "A\tE\t1"),
+            ("weighted-edges.txt", "S1\tT1\t0.01"),
+            ("loop-edges.txt", "T2\tS1\t0.5"),
+        ],
+    )
+    def test_incremental(self, edges, edit, capsys):
+        out_dir = Path(TEST_DIR, "output", "incremental", "-".join([Path(edges).stem] + edit.split()))
+        out_dir.mkdir(parents=True, exist_ok=True)
+        edges_path = Path(out_dir, "edges.txt")
+        inc_file = Path(out_dir, "incremental-output.txt")
+        plain_file = Path(out_dir, "output.txt")
+        Path(out_dir, "incremental-output.txt.state.json").unlink(missing_ok=True)
+        inputs = {
+            "sources_path": Path(TEST_DIR, "input", "btb-sources.txt"),
+            "targets_path": Path(TEST_DIR, "input", "btb-targets.txt"),
+        }
+
+        original = Path(TEST_DIR, "input", edges).read_text().rstrip("\n")
+        edges_path.write_text(original + "\n")
+        btb_wrapper(edges=edges_path, output_file=inc_file, incremental=True, **inputs)
+        btb_wrapper(edges=edges_path, output_file=inc_file, incremental=True, **inputs)
+        replayed = [line.split() for line in capsys.readouterr().out.splitlines() if line.startswith("Replayed")]
+        assert replayed[-1][1] == replayed[-1][3]
+
+        edges_path.write_text(original + "\n" + edit + "\n")
+        btb_wrapper(edges=edges_path, output_file=inc_file, incremental=True, **inputs)
+        btb_wrapper(edges=edges_path, output_file=plain_file, **inputs)
+        assert inc_file.read_text() == plain_file.read_text()
+
+    """
+    Ask for a resident memory limit with memory storage, which has no mapped pages to drop
+    """
+
+    def test_max_rss_needs_mmap(self):
+        with pytest.raises(ValueError, match="mmap"):
+            btb_wrapper(
+                edges=Path(TEST_DIR, "input", "btb-edges.txt"),
+                sources_path=Path(TEST_DIR, "input", "btb-sources.txt"),
+                targets_path=Path(TEST_DIR, "input", "btb-targets.txt"),
+                output_file=OUT_FILE,
+                max_rss=512,
+            )
+
+    """
+    Run an ensemble of replicates without noise, which should all give the pathway of a single run
+    """
+
+    def test_ensemble_without_noise(self):
+        out_file = Path(TEST_DIR, "output", "ensemble", "frequencies.txt")
+        btb_wrapper(
+            edges=Path(TEST_DIR, "input", "weighted-edges.txt"),
+            sources_path=Path(TEST_DIR, "input", "btb-sources.txt"),
+            targets_path=Path(TEST_DIR, "input", "btb-targets.txt"),
+            output_file=out_file,
+            ensemble=3,
+            noise=0,
+            workers=2,
+        )
+        with open(Path(TEST_DIR, "expected_output", "weighted-output.txt"), "r") as expected_output_file:
+            expected_content = set(expected_output_file.read().splitlines())
+        for r in range(3):
+            with open(Path(out_file.parent, "frequencies-replicates", f"replicate-{r}.txt"), "r") as output_file:
+                assert set(output_file.read().splitlines()) == expected_content
+        with open(out_file, "r") as output_file:
+            lines = output_file.read().splitlines()
+        assert lines[0] == "Node1\tNode2\tFrequency"
+        assert {line.rsplit("\t", 1)[0] for line in lines[1:]} == expected_content - {"Node1\tNode2"}
+        assert {line.rsplit("\t", 1)[1] for line in lines[1:]} == {"1.0"}
+
+    """
+    Perturbed replicates depend on the seed and not on the number of workers or the storage
+    """
+
+    def test_ensemble_workers(self):
+        outputs = []
+        for storage, workers in [("memory", 1), ("memory", 2), ("mmap", 2)]:
+            out_file = Path(TEST_DIR, "output", "ensemble", f"{storage}-workers-{workers}.txt")
+            btb_wrapper(
+                edges=Path(TEST_DIR, "input", "weighted-edges.txt"),
+                sources_path=Path(TEST_DIR, "input", "btb-sources.txt"),
+                targets_path=Path(TEST_DIR, "input", "btb-targets.txt"),
+                output_file=out_file,
+                ensemble=8,
+                perturbation="uniform",
+                noise=0.5,
+                seed=7,
+                workers=workers,
+                storage=storage,
+            )
+            replicates = [
+                Path(out_file.parent, f"{out_file.stem}-replicates", f"replicate-{r}.txt").read_text()
+                for r in range(8)
+            ]
+            outputs.append((out_file.read_text(), replicates))
+        assert outputs[0] == outputs[1] == outputs[2]
+
+    """
+    Perturb unit weights, which edges without a weight column get, and weights below the noise scale: every
+    replicate should move the unit weights below 1 by a different amount and keep every edge
+    """
+
+    @pytest.mark.parametrize("model", btb.PERTURBATIONS)
+    def test_perturb_unit_weights(self, model):
+        costs = weight_costs([1.0] * 1000 + [0.05] * 1000)
+        replicates = [perturb_costs(costs, model, 0.5, f"7-{r}") for r in range(3)]
+        for perturbed in replicates:
+            assert all(0 < cost < float("inf") for cost in perturbed)
+            assert len(set(perturbed[:1000])) == 1000
+        assert replicates[0] != replicates[1] != replicates[2]
+        assert perturb_costs(costs, model, 0.5, "7-0") == replicates[0]
+        assert perturb_costs(costs, model, 0, "7-0") == costs
+
+    """
+    Run BowTieBuilder from Python on edge tuples and on a network prepared from columns
+    """
+
+    @pytest.mark.parametrize(
+        "edges, expected",
+        [
+            ("btb-edges.txt", "btb-output.txt"),
+            ("bidirectional-edges.txt", "bidirectional-output.txt"),
+            ("loop-edges.txt", "loop-output.txt"),
+            ("weighted-edges.txt", "weighted-output.txt"),
+        ],
+    )
+    def test_bowtiebuilder(self, edges, expected):
+        edge_list = read_edges(Path(TEST_DIR, "input", edges))
+        sources, targets = read_source_target(
+            Path(TEST_DIR, "input", "btb-sources.txt"), Path(TEST_DIR, "input", "btb-targets.txt")
+        )
+        with open(Path(TEST_DIR, "expected_output", expected), "r") as expected_output_file:
+            expected_content = set(expected_output_file.read().splitlines()) - {"Node1\tNode2"}
+
+        tails, heads = bowtiebuilder(edge_list, sources, targets)
+        assert {u + "\t" + v for u, v in zip(tails, heads)} == expected_content
+
+        network = PreparedNetwork.from_arrays(*zip(*edge_list))
+        for _ in range(2):
+            tail_ids, head_ids = bowtiebuilder(network, tuple(sources), tuple(targets), node_ids=True)
+            assert [network.node_name(u) for u in tail_ids] == tails
+            assert [network.node_name(v) for v in head_ids] == heads
+
+    """
+    Copy a prepared network into shared memory, attach to it as a worker would and unlink it on close
+    """
+
+    def test_shared_network(self):
+        edge_list = read_edges(Path(TEST_DIR, "input", "btb-edges.txt"))
+        sources, targets = read_source_target(
+            Path(TEST_DIR, "input", "btb-sources.txt"), Path(TEST_DIR, "input", "btb-targets.txt")
+        )
+        prepared = PreparedNetwork(edge_list)
+        with SharedNetwork.create(prepared) as shared:
+            attached = pickle.loads(pickle.dumps(shared))
+            assert [attached.node_name(i) for i in range(len(attached))] == prepared.names
+            assert [attached.node_id(name) for name in prepared.names] == list(range(len(prepared)))
+            assert list(attached.costs) == list(prepared.costs)
+            assert bowtiebuilder(attached, sources, targets) == bowtiebuilder(prepared, sources, targets)
+            attached.close()
+            name = shared.handle[0]
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name)
+
+    """
+    Send several shared networks in turn to one long-lived worker, which should map each one once and let go of
+    the earlier ones
+    """
+
+    @pytest.mark.skipif(not Path("/proc/self/maps").exists(), reason="needs /proc/self/maps")
+    def test_shared_network_sequence(self):
+        edge_list = read_edges(Path(TEST_DIR, "input", "btb-edges.txt"))
+        sources, targets = read_source_target(
+            Path(TEST_DIR, "input", "btb-sources.txt"), Path(TEST_DIR, "input", "btb-targets.txt")
+        )
+        prepared = PreparedNetwork(edge_list)
+        expected = bowtiebuilder(prepared, sources, targets)
+        names = []
+        with multiprocessing.Pool(1) as pool:
+            for _ in range(5):
+                with SharedNetwork.create(prepared) as shared:
+                    names.append(shared.handle[0])
+                    for _ in range(3):
+                        assert pool.apply(bowtiebuilder, (shared, sources, targets)) == expected
+                    assert [name for name in pool.apply(mapped_segments) if name in names] == names[-1:]
+
+    """
+    Pass a shared network to pool workers with every task, as in the README, and let an attached network be
+    garbage collected: both should detach without errors, and unpickling should reuse the process's attachment
+    """
+
+    def test_shared_network_pool(self, capfd, monkeypatch):
+        edge_list = read_edges(Path(TEST_DIR, "input", "btb-edges.txt"))
+        sources, targets = read_source_target(
+            Path(TEST_DIR, "input", "btb-sources.txt"), Path(TEST_DIR, "input", "btb-targets.txt")
+        )
+        prepared = PreparedNetwork(edge_list)
+        expected = bowtiebuilder(prepared, sources, targets)
+        unraisable = []
+        monkeypatch.setattr(sys, "unraisablehook", unraisable.append)
+        with SharedNetwork.create(prepared) as shared:
+            with multiprocessing.Pool(2) as pool:
+                results = pool.starmap(bowtiebuilder, [(shared, sources, targets)] * 20)
+            assert results == [expected] * 20
+
+            attached = pickle.loads(pickle.dumps(shared))
+            assert pickle.loads(pickle.dumps(shared)) is attached
+            attached.close()
+            assert pickle.loads(pickle.dumps(shared)) is not attached
+
+            attached = SharedNetwork(*shared.handle)
+            assert bowtiebuilder(attached, sources, targets) == expected
+            del attached
+            gc.collect()
+        assert unraisable == []
+        assert "Error" not in capfd.readouterr().err